@@ -8,9 +8,24 @@ ANY_SOURCE_EVENTS = 2
 NO_SOURCE_EVENTS = 3
 
 
+class AgentType(type):
+    '''
+    Builds each agent class's fully qualified name once,
+    when the class is defined.
+    '''
+    def __init__(cls, name, bases, attrs):
+        super(AgentType, cls).__init__(name, bases, attrs)
+        cls._qualname = cls.__module__ + '.' + name
+
+
 class Agent(object):
+    __metaclass__ = AgentType
+
     can_generate_events = True
     can_receive_events = True
+    # set when receive_webhook changes nothing on the agent, so the
+    # webhook doesn't need to save it
+    is_read_only = False
 
     def __init__(self, agent):
         self.store = agent
@@ -30,6 +45,9 @@ class Agent(object):
         Implement logic here for running an agent.
         Any return values will be used as event data to be queued
         if the agent's `can_generate_events' is set to True.
+        All the events passed in are consumed once this returns, whether
+        or not the agent called `done()' on them; if it raises, only the
+        events it called `done()' on are.
         '''
         raise NotImplementedError()
 
@@ -63,4 +81,4 @@ class Agent(object):
 
     @classmethod
     def fully_qualified_name(cls):
-        return cls.__module__ + '.' + cls.__name__
+        return cls._qualname
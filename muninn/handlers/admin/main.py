@@ -1,6 +1,7 @@
 import logging
 import os
 import json
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 
 import webapp2
@@ -9,6 +10,7 @@ import jinja2
 from muninn.agents.default import EmailAgent, URLFetchAgent, PrintEventsAgent, WebhookAgent
 from muninn.agents.google_spreadsheet import GoogleSpreadsheetAgent
 from muninn.agents.hipchat import HipchatAgent
+from muninn import migrations
 from muninn.models import AgentStore, cls_from_name
 
 
@@ -104,6 +106,7 @@ class RunAllAgents(BaseHandler):
 
 class ListAllAgents(BaseHandler):
     def get(self):
+        # full entities: counting queued events reads source_keys
         agents = AgentStore.all()
         template = templates.get_template('list_all_agents.html')
         return self.response.out.write(template.render({'agents': agents, 'page_title': 'All Agents'}))
@@ -117,6 +120,14 @@ class ResetDedupHandler(BaseHandler):
                 agent.put()
 
 
+class MigrateHandler(BaseHandler):
+    def get(self):
+        deferred.defer(migrations.purge_done_events)
+        deferred.defer(migrations.migrate_source_agents)
+        self.response.content_type = 'text/plain'
+        self.response.out.write('Migrations queued.\n')
+
+
 class AddAgent(BaseHandler):
     def get(self):
         # TODO: don't hard code this dict
@@ -128,7 +139,10 @@ class AddAgent(BaseHandler):
             "Google Spreadsheet": GoogleSpreadsheetAgent,
             "Hipchat": HipchatAgent
         }
-        agents = AgentStore.all()
+        agents = AgentStore.all(projection=[
+            AgentStore.name,
+            AgentStore.can_generate_events
+        ])
         template = templates.get_template('add_agent.html')
         return self.response.out.write(template.render({
             'registered_agents': registered_agents,
@@ -166,4 +180,5 @@ app = webapp2.WSGIApplication([
     ('/muninn/admin/agents/all/?', ListAllAgents),
     ('/muninn/admin/agents/add/?', AddAgent),
     ('/muninn/admin/agents/reset_dedup/?', ResetDedupHandler),
+    ('/muninn/admin/migrate/?', MigrateHandler),
 ], debug=True)
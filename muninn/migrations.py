@@ -0,0 +1,71 @@
+'''
+One-off data migrations, run as deferred task chains.
+Queue them from /muninn/admin/migrate/.
+'''
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+from muninn.models import BATCH_SIZE, MAX_BATCH_PUT, SOURCE_KEYS_MIGRATION
+from muninn.models import Event, LegacySourceAgent, MigrationState
+from muninn.models import delete_multi
+
+
+def purge_done_events(cursor=None):
+    '''
+    Delete the events flagged is_done by earlier versions, which
+    deleted nothing and kept done events around.
+    '''
+    if cursor is not None:
+        cursor = Cursor(urlsafe=cursor)
+    keys, cursor, more = Event.query(Event.is_done == True).fetch_page(
+        MAX_BATCH_PUT, start_cursor=cursor, keys_only=True)
+    delete_multi(keys)
+    if more and cursor:
+        deferred.defer(purge_done_events, cursor.urlsafe())
+
+
+# agent tasks are cut off after 10 minutes, so past this any run that
+# loaded an agent before its source_keys were filled has saved it
+RUN_DEADLINE = 11 * 60
+
+
+def migrate_source_agents(cursor=None, final=False):
+    '''
+    Copy the legacy SourceAgent edge rows into AgentStore.source_keys.
+
+    A run that loaded an agent before the copy saves it back without
+    the new keys, so once the first pass is done a second one, started
+    after any such run has ended, copies the edges again, deletes them
+    and marks the migration done. Until then lookups read both.
+    '''
+    if cursor is not None:
+        cursor = Cursor(urlsafe=cursor)
+    edges, cursor, more = LegacySourceAgent.query().fetch_page(
+        BATCH_SIZE, start_cursor=cursor)
+    sources = {}
+    for edge in edges:
+        sources.setdefault(edge.agent, []).append(edge.source)
+    for agent_key, source_keys in sources.items():
+        _add_source_keys(agent_key, source_keys)
+    if final:
+        delete_multi([edge.key for edge in edges])
+
+    if more and cursor:
+        deferred.defer(migrate_source_agents, cursor.urlsafe(), final)
+    elif not final:
+        deferred.defer(migrate_source_agents, final=True,
+                       _countdown=RUN_DEADLINE)
+    else:
+        MigrationState(id=SOURCE_KEYS_MIGRATION, done=True).put()
+
+
+@ndb.transactional
+def _add_source_keys(agent_key, source_keys):
+    agent = agent_key.get()
+    if agent is None:
+        return
+    missing = [k for k in source_keys if k not in agent.source_keys]
+    if missing:
+        agent.source_keys.extend(missing)
+        agent.put()
@@ -4,19 +4,205 @@ add_lib_path()
 import datetime
 import hashlib
 import logging
+import threading
+import time
 from importlib import import_module
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
+from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 import json
 from crontab import CronTab
 
 
+_cls_cache = {}
+
+
 def cls_from_name(name):
-    parts = name.rsplit('.', 1)
-    cls = getattr(import_module(parts[0]), parts[1])
+    cls = _cls_cache.get(name)
+    if cls is None:
+        parts = name.rsplit('.', 1)
+        cls = getattr(import_module(parts[0]), parts[1])
+        _cls_cache[name] = cls
     return cls
 
 
+# Datastore accepts at most 500 entities per batch write
+MAX_BATCH_PUT = 500
+
+# size of the chunks batch gets and puts are split into; the chunks
+# are issued concurrently, which beats a single large batch
+BATCH_SIZE = 100
+
+
+def _chunks(items, size=BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+@ndb.tasklet
+def get_multi_async(keys, **ctx_options):
+    '''
+    Like ndb.get_multi_async, but split into concurrent BATCH_SIZE chunks
+    '''
+    futures = []
+    for chunk in _chunks(keys):
+        futures.extend(ndb.get_multi_async(chunk, **ctx_options))
+    entities = yield futures
+    raise ndb.Return(entities)
+
+
+def get_multi(keys, **ctx_options):
+    return get_multi_async(keys, **ctx_options).get_result()
+
+
+def put_multi(entities, **ctx_options):
+    '''
+    Like ndb.put_multi, but split into concurrent BATCH_SIZE chunks
+    '''
+    futures = []
+    for chunk in _chunks(entities):
+        futures.extend(ndb.put_multi_async(chunk, **ctx_options))
+    return [f.get_result() for f in futures]
+
+
+def delete_multi(keys, **ctx_options):
+    '''
+    Like ndb.delete_multi, but split into concurrent BATCH_SIZE chunks
+    '''
+    futures = []
+    for chunk in _chunks(keys):
+        futures.extend(ndb.delete_multi_async(chunk, **ctx_options))
+    return [f.get_result() for f in futures]
+
+_buffers = threading.local()
+
+
+class EventBuffer(object):
+    '''
+    Collect Event writes and deletes made inside the block and send
+    them in batches on exit, e.g.:
+
+        with EventBuffer():
+            agent.add_event(data)
+            agent._put_events_queue()
+
+    Entities passed to save_after (agents whose dedup_hashs or last_run
+    record those events) are only saved once the events are. Writes are
+    only dropped from the buffer once they succeed; if one fails, nothing
+    queued after it is sent, the save_after entities included, and the
+    buffer is discarded on exit instead of being flushed again.
+
+    Nested buffers share the outermost one.
+    '''
+
+    def __init__(self, max_size=MAX_BATCH_PUT):
+        self.max_size = max_size
+        self.entities = []
+        self.deleted_keys = set()
+        self.after = []
+        self._failed = False
+        self._outer = None
+
+    @classmethod
+    def current(cls):
+        return getattr(_buffers, 'current', None)
+
+    def __enter__(self):
+        self._outer = EventBuffer.current()
+        if self._outer is not None:
+            return self._outer
+        _buffers.current = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._outer is not None:
+            return False
+        try:
+            if not self._failed:
+                self.flush()
+        finally:
+            _buffers.current = None
+        return False
+
+    def add(self, entities):
+        self.entities.extend(entities)
+        self._check_size()
+
+    def delete(self, keys):
+        self.deleted_keys.update(keys)
+        self._check_size()
+
+    def save_after(self, entities):
+        for entity in entities:
+            if not any(entity is e for e in self.after):
+                self.after.append(entity)
+
+    def _check_size(self):
+        if len(self.entities) + len(self.deleted_keys) >= self.max_size:
+            self.flush()
+
+    def flush(self):
+        if self._failed:
+            raise RuntimeError('EventBuffer: an earlier flush failed')
+        try:
+            while self.entities:
+                batch = self.entities[:self.max_size]
+                put_multi(batch)
+                self.entities = self.entities[len(batch):]
+            if self.deleted_keys:
+                for batch in _chunks(list(self.deleted_keys), self.max_size):
+                    delete_multi(batch)
+                    self.deleted_keys.difference_update(batch)
+            if self.after:
+                put_multi(self.after)
+                self.after = []
+        except Exception:
+            self._failed = True
+            self.entities = []
+            self.deleted_keys = set()
+            self.after = []
+            raise
+
+
+# read-only webhook agents save last_run at most once per interval
+LAST_RUN_INTERVAL = 60
+
+
+def _last_run_cache_key(key):
+    return 'last_run:%s' % key.id()
+
+
+def _defer_last_run(key, last_run):
+    '''
+    Keep the latest last_run in memcache and queue at most one task
+    per agent and LAST_RUN_INTERVAL to save it, so busy webhooks don't
+    contend on the agent's entity group.
+    '''
+    memcache.set(_last_run_cache_key(key), last_run,
+                 time=LAST_RUN_INTERVAL * 2)
+    interval = int(time.time()) // LAST_RUN_INTERVAL
+    try:
+        deferred.defer(_update_last_run, key, last_run,
+                       _name='last-run-%s-%d' % (key.id(), interval),
+                       _countdown=LAST_RUN_INTERVAL)
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        pass
+
+
+@ndb.transactional
+def _update_last_run(key, last_run):
+    latest = memcache.get(_last_run_cache_key(key))
+    if latest is not None and latest > last_run:
+        last_run = latest
+    agent = key.get()
+    if agent is not None and (agent.last_run is None or
+                              agent.last_run < last_run):
+        agent.last_run = last_run
+        agent.put()
+
+
 class AgentStore(ndb.Model):
     name = ndb.StringProperty()
     type = ndb.StringProperty()
@@ -31,6 +217,8 @@ class AgentStore(ndb.Model):
     can_generate_events = ndb.BooleanProperty(default=True)
     is_running = ndb.BooleanProperty(default=False)
     deduplicate_output_events = ndb.BooleanProperty(default=False)
+    # agents this agent is listening to for events
+    source_keys = ndb.KeyProperty(kind='AgentStore', repeated=True)
 
 
     def __init__(self, **kwargs):
@@ -41,40 +229,38 @@ class AgentStore(ndb.Model):
     def new(cls, name, agent_cls, cron_entry=None, source_agents=None, config=config, deduplicate_output_events=False):
         if source_agents is None or not agent_cls.can_receive_events:
             source_agents = []
+        source_keys = [s.key for s in source_agents
+                       if s.can_generate_events]
         agent = cls(
             name=name,
-            type=agent_cls.__module__ + '.' + agent_cls.__name__,
+            type=agent_cls.fully_qualified_name(),
             can_receive_events=agent_cls.can_receive_events,
             can_generate_events=agent_cls.can_generate_events,
             config=config,
             cron_entry=cron_entry,
-            deduplicate_output_events=deduplicate_output_events
+            deduplicate_output_events=deduplicate_output_events,
+            source_keys=source_keys
         )
         agent._update_next_run()
         if deduplicate_output_events:
             agent.dedup_hashs = []
         agent.put()
-        if source_agents:
-            source_agent_keys = []
-            for source_agent in source_agents:
-                if not source_agent.can_generate_events:
-                    continue
-                key = SourceAgent(
-                    agent=agent.key,
-                    source=source_agent.key
-                )
-                source_agent_keys.append(key)
-            ndb.put_multi(source_agent_keys)
+        if source_keys:
+            SourceAgent.add_listener(source_keys, agent.key)
         return agent
 
     @classmethod
-    def all(cls, type=None, name=None):
+    def all(cls, type=None, name=None, projection=None):
+        '''
+        Get all active agents. Pass a projection when only a few
+        fields will be read, the entities returned can't be saved.
+        '''
         filters = [cls.is_active == True]
         if type is not None:
             filters.append(cls.type == type)
         if name is not None:
             filters.append(cls.name == name)
-        return cls.query(*filters).fetch()
+        return cls.query(*filters).fetch(projection=projection)
 
     @classmethod
     def due(cls, time):
@@ -85,7 +271,7 @@ class AgentStore(ndb.Model):
         ).fetch()
         return agents
 
-    def _put_events_queue(self):
+    def _put_events_queue(self, listening_keys=None):
         '''
         Save any queued events into the datastore
         '''
@@ -94,8 +280,8 @@ class AgentStore(ndb.Model):
         if not self.can_generate_events:
             logging.info("Cannot generate events, so cancel saving them")
             return
-        listening_agents = SourceAgent.get_listening_agents(self)
 
+        new_events = []
         for event_data in self._new_events_queue:
             if event_data is None:
                 logging.info("empty event")
@@ -105,16 +291,29 @@ class AgentStore(ndb.Model):
                 logging.info("Event is duplicated, so skipping it")
                 continue
 
-            for agent in listening_agents:
-                event = Event(data=event_data,
-                              source=self.key,
-                              target=agent.key)
-                events.append(event)
-        ndb.put_multi(events)
+            new_events.append(event_data)
+
+        if new_events:
+            # listeners are looked up once, whatever the queue's length,
+            # and not at all when there is nothing to save
+            if listening_keys is None:
+                listening_keys = SourceAgent.get_listening_agent_keys(self)
+            events = [Event(data=event_data, source=self.key, target=key)
+                      for event_data in new_events
+                      for key in listening_keys]
+
+        buf = EventBuffer.current()
+        if buf is not None:
+            buf.add(events)
+        else:
+            put_multi(events)
 
         if self.deduplicate_output_events and len(events):
-            #making sure we save the hashes
-            self.put()
+            #making sure we save the hashes, after the events they record
+            if buf is not None:
+                buf.save_after([self])
+            else:
+                self.put()
 
         self._new_events_queue = []
 
@@ -150,8 +349,11 @@ class AgentStore(ndb.Model):
         if not self.can_receive_events:
             return []
         if source_agents is None:
-            source_agents = SourceAgent.get_source_agents(self)
-        return Event.for_agent(self, source_agents)
+            source_keys = SourceAgent.get_source_agent_keys(self)
+        else:
+            source_keys = [s.key for s in source_agents]
+        events, _ = Event.for_agent(self.key, source_keys)
+        return events
 
     def add_event(self, data):
         '''
@@ -167,20 +369,35 @@ class AgentStore(ndb.Model):
         if not self.is_active:
             return
         self.is_running = True
-        try:
-            agent_cls = cls_from_name(self.type)
-            events = self.receive_events()
-            self._new_events_queue = []
-            agent = agent_cls(self)
-            result = agent.run(events)
-            if result is not None:
-                self.add_event(result)
-            self._put_events_queue()
-        finally:
-            self.last_run = datetime.datetime.now()
-            self.is_running = False
-            self._update_next_run()
-            self.put()
+        # events marked done by the agent and the new events it queues
+        # are saved in one batch, even if the agent fails
+        with EventBuffer() as buf:
+            listeners = None
+            try:
+                # look up the listeners while the events are fetched
+                if self.can_generate_events:
+                    listeners = SourceAgent.get_listening_agent_keys_async(self)
+                agent_cls = cls_from_name(self.type)
+                events = self.receive_events()
+                self._new_events_queue = []
+                agent = agent_cls(self)
+                result = agent.run(events)
+                Event.mark_done([e.key for e in events])
+                if result is not None:
+                    self.add_event(result)
+                self._put_events_queue(
+                    listeners.get_result() if listeners else None)
+            finally:
+                if listeners is not None:
+                    # don't leave the lookup pending if the agent failed
+                    listeners.wait()
+                self.last_run = datetime.datetime.now()
+                self.is_running = False
+                self._update_next_run()
+                # flush now, even inside an outer buffer: this run's
+                # events have to be saved before the agent's state
+                buf.save_after([self])
+                buf.flush()
 
     def receive_webhook(self, request, response):
         '''
@@ -190,10 +407,18 @@ class AgentStore(ndb.Model):
             response.set_status(404)
             return
 
-        self.is_running = True
-        self.put()
+        agent_cls = cls_from_name(self.type)
+        if agent_cls.is_read_only:
+            # nothing to save, so only record the run, off the request
+            try:
+                agent = agent_cls(self)
+                agent.receive_webhook(request, response)
+            finally:
+                _defer_last_run(self.key, datetime.datetime.now())
+            return
+
+        self._acquire_running()
         try:
-            agent_cls = cls_from_name(self.type)
             self._new_events_queue = []
             agent = agent_cls(self)
             agent.receive_webhook(request, response)
@@ -202,6 +427,16 @@ class AgentStore(ndb.Model):
             self.is_running = False
             self.put()
 
+    def _acquire_running(self):
+        '''
+        Flag this agent as running. The flag is only saved right away
+        when the agent has a schedule, i.e. when the cron could pick it
+        up meanwhile; otherwise the final put records the run.
+        '''
+        self.is_running = True
+        if self.next_run is not None:
+            self.put()
+
     def run_taskqueue(self, queue_name='agents'):
         self.is_running = True
         self.put()
@@ -213,25 +448,73 @@ class AgentStore(ndb.Model):
         return task
 
 
+# Event.for_agent runs one query per source, concurrently, up to this
+# many sources; past it a single IN query is used
+MAX_PARALLEL_SOURCES = 30
+
+
 class Event(ndb.Model):
     data = ndb.JsonProperty()
     source = ndb.KeyProperty(kind=AgentStore)
     target = ndb.KeyProperty(kind=AgentStore)
+    # done events are deleted now; this is only kept, with the filters
+    # on it, until muninn.migrations.purge_done_events has removed the
+    # events flagged done before that
     is_done = ndb.BooleanProperty(default=False)
 
     @classmethod
-    def for_agent(cls, agent, source_agents, limit=2000):
+    def for_agent(cls, agent_key, source_agent_keys, limit=2000,
+                  keys_only=False, start_cursor=None):
         '''
-        Get events for an agent from a list of source_agents
+        Get a page of events for an agent from a list of source agents,
+        both given by key.
+        Use keys_only when the events' data is not needed.
+
+        Returns (events, next_cursor). Events are ordered by key and
+        next_cursor is the key of the last one, pass it as start_cursor
+        to get the next page; it is None once the last page is reached.
+
+        An IN filter is run by ndb as one subquery per value, one after
+        the other, so for 2 to MAX_PARALLEL_SOURCES sources the
+        per-source queries are issued concurrently instead and merged.
+        A single source is one plain query.
         '''
-        # TODO: paginate?
         events = Event.query(Event.is_done == False,
-                             Event.target == agent.key)
-        if source_agents:
-            # so if source_agents is empty, get all events for agent
-            source_agents = [s.key for s in source_agents]
-            events = events.filter(Event.source.IN(source_agents))
-        return events.fetch(limit=limit)
+                             Event.target == agent_key)
+        if start_cursor is not None:
+            events = events.filter(Event.key > start_cursor)
+        events = events.order(Event.key)
+        if 1 < len(source_agent_keys or []) <= MAX_PARALLEL_SOURCES:
+            # only keys per source, so that only the merged page is
+            # loaded rather than up to limit events for every source
+            futures = [
+                events.filter(Event.source == key).fetch_async(
+                    limit=limit, keys_only=True)
+                for key in source_agent_keys
+            ]
+            keys = []
+            for future in futures:
+                keys.extend(future.get_result())
+            keys.sort()
+            keys = keys[:limit]
+            next_cursor = keys[-1] if len(keys) == limit else None
+            if keys_only:
+                return keys, next_cursor
+            # events deleted since the query are skipped; they are about
+            # to be consumed, so they are kept out of the caches
+            events = get_multi(keys, use_cache=False, use_memcache=False)
+            return [e for e in events if e is not None], next_cursor
+
+        if len(source_agent_keys or []) == 1:
+            events = events.filter(Event.source == source_agent_keys[0])
+        elif source_agent_keys:
+            events = events.filter(Event.source.IN(source_agent_keys))
+        # so if source_agent_keys is empty, get all events for agent
+        results = events.fetch(limit=limit, keys_only=keys_only)
+        if len(results) < limit:
+            return results, None
+        last = results[-1]
+        return results, last if keys_only else last.key
 
     @classmethod
     def for_agent_from_source(cls, agent, source_agent, limit=25):
@@ -255,25 +538,184 @@ class Event(ndb.Model):
         return events.fetch(limit=limit)
 
     def done(self):
-        self.is_done = True
-        self.put()
+        '''
+        Deprecated: AgentStore.run marks all the events it passed to
+        the agent as done once the agent returns. While a run is in
+        progress this only queues the delete.
+        '''
+        Event.mark_done([self.key])
+
+    @classmethod
+    def mark_done(cls, keys):
+        '''
+        Mark the events with the given keys as done. Done events are
+        never read again, so they are deleted.
+        '''
+        buf = EventBuffer.current()
+        if buf is not None:
+            buf.delete(keys)
+        else:
+            delete_multi(keys)
 
 
-class SourceAgent(ndb.Model):
+class LegacySourceAgent(ndb.Model):
+    '''
+    Edge rows of the SourceAgent kind, from before AgentStore.source_keys.
+    Still read until muninn.migrations.migrate_source_agents has copied
+    them into source_keys.
+    '''
     agent = ndb.KeyProperty(kind=AgentStore)
     source = ndb.KeyProperty(kind=AgentStore)
 
+    @classmethod
+    def _get_kind(cls):
+        return 'SourceAgent'
+
+
+class MigrationState(ndb.Model):
+    '''
+    Marks a one-off migration as done, keyed by the migration's name
+    '''
+    done = ndb.BooleanProperty(default=False)
+
+
+# MigrationState id of muninn.migrations.migrate_source_agents
+SOURCE_KEYS_MIGRATION = 'source_keys'
+
+# set once the migration is seen done, so each instance stops reading
+# its MigrationState. This, LegacySourceAgent, MigrationState and the
+# legacy lookups in SourceAgent can be deleted in the release after
+# the one that shipped the migration, once it has run everywhere.
+_legacy_edges_migrated = False
+
+
+@ndb.tasklet
+def _legacy_edges_pending_async():
+    global _legacy_edges_migrated
+    if _legacy_edges_migrated:
+        raise ndb.Return(False)
+    state = yield MigrationState.get_by_id_async(SOURCE_KEYS_MIGRATION)
+    if state is not None and state.done:
+        _legacy_edges_migrated = True
+    raise ndb.Return(not _legacy_edges_migrated)
+
+
+# the agents graph only changes in AgentStore.new, which updates the
+# cached listener lists it touches; the timeout is only a safety net
+EDGES_CACHE_TIMEOUT = 300
+
+# attempts at updating a cached listener list before giving up on it
+EDGES_CACHE_RETRIES = 5
+
+
+class SourceAgent(object):
+    '''
+    Lookups over the agents graph. Each AgentStore keeps the keys of
+    the agents it listens to in source_keys.
+    '''
+
+    @staticmethod
+    def _listeners_cache_key(key):
+        return 'listeners:%s' % key.id()
+
+    @classmethod
+    @ndb.tasklet
+    def _query_listener_keys_async(cls, source_key):
+        keys = yield AgentStore.query(
+            AgentStore.source_keys == source_key
+        ).fetch_async(keys_only=True)
+        pending = yield _legacy_edges_pending_async()
+        if pending:
+            edges = yield LegacySourceAgent.query(
+                LegacySourceAgent.source == source_key
+            ).fetch_async()
+            keys.extend(e.agent for e in edges if e.agent not in keys)
+        raise ndb.Return(keys)
+
+    @classmethod
+    def add_listener(cls, source_keys, agent_key):
+        '''
+        Add agent_key to the cached listener lists of source_keys.
+        The lists are updated rather than cleared: the query refilling
+        a cleared list may not see the new agent yet.
+        '''
+        client = memcache.Client()
+        for source_key in set(source_keys):
+            cache_key = cls._listeners_cache_key(source_key)
+            for _ in range(EDGES_CACHE_RETRIES):
+                keys = client.gets(cache_key)
+                if keys is None:
+                    keys = cls._query_listener_keys_async(
+                        source_key).get_result()
+                    if agent_key not in keys:
+                        keys.append(agent_key)
+                    if client.add(cache_key, keys,
+                                  time=EDGES_CACHE_TIMEOUT):
+                        break
+                elif agent_key in keys:
+                    break
+                elif client.cas(cache_key, keys + [agent_key],
+                                time=EDGES_CACHE_TIMEOUT):
+                    break
+            else:
+                client.delete(cache_key)
+
+    @classmethod
+    @ndb.tasklet
+    def get_listening_agent_keys_async(cls, source_agent):
+        ctx = ndb.get_context()
+        cache_key = cls._listeners_cache_key(source_agent.key)
+        keys = yield ctx.memcache_get(cache_key)
+        if keys is None:
+            keys = yield cls._query_listener_keys_async(source_agent.key)
+            # add, not set: never replace a list add_listener has
+            # updated since this query ran
+            yield ctx.memcache_add(cache_key, keys,
+                                   time=EDGES_CACHE_TIMEOUT)
+        raise ndb.Return(keys)
+
+    @classmethod
+    def get_listening_agent_keys(cls, source_agent):
+        '''
+        Return the keys of the agents that are listening for
+        events from source_agent.
+        '''
+        return cls.get_listening_agent_keys_async(source_agent).get_result()
+
     @classmethod
     def get_listening_agents(cls, source_agent):
         '''
         Return a list of agents that are listening for
         events from souce_agent.
         '''
-        agents = cls.query(
-            SourceAgent.source == source_agent.key
-        ).fetch()
-        keys = [a.agent for a in agents]
-        return ndb.get_multi(keys)
+        return get_multi(cls.get_listening_agent_keys(source_agent))
+
+    @classmethod
+    @ndb.tasklet
+    def get_source_agent_keys_async(cls, agent):
+        keys = list(agent.source_keys)
+        pending = yield _legacy_edges_pending_async()
+        if pending:
+            edges = yield LegacySourceAgent.query(
+                LegacySourceAgent.agent == agent.key
+            ).fetch_async()
+            keys.extend(e.source for e in edges if e.source not in keys)
+        raise ndb.Return(keys)
+
+    @classmethod
+    def get_source_agent_keys(cls, agent):
+        '''
+        Return the keys of the agents that agent is
+        listening to for events.
+        '''
+        return cls.get_source_agent_keys_async(agent).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_source_agents_async(cls, agent):
+        keys = yield cls.get_source_agent_keys_async(agent)
+        sources = yield get_multi_async(keys)
+        raise ndb.Return(sources)
 
     @classmethod
     def get_source_agents(cls, agent):
@@ -281,8 +723,4 @@ class SourceAgent(ndb.Model):
         Return a list of agents that agent is
         listening to for events.
         '''
-        agents = cls.query(
-            SourceAgent.agent == agent.key
-        ).fetch()
-        keys = [a.source for a in agents]
-        return ndb.get_multi(keys)
+        return cls.get_source_agents_async(agent).get_result()
@@ -20,6 +20,13 @@ class MuteAgent(Agent):
         return {'event_data': events}
 
 
+class ReadOnlyAgent(Agent):
+    is_read_only = True
+
+    def receive_webhook(self, request, response):
+        response.out.write('ok')
+
+
 class AgentTestCase(unittest.TestCase):
     '''Tests for Agent model'''
     def setUp(self):
@@ -27,6 +34,7 @@ class AgentTestCase(unittest.TestCase):
         self.testbed.setup_env('muninn')
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
 
     def tearDown(self):
         self.testbed.deactivate()
@@ -1,14 +1,21 @@
 from __future__ import absolute_import
 import datetime
+import os
 import time
 import random
 import unittest
 
+from google.appengine.ext import deferred
 from google.appengine.ext import testbed
+from google.appengine.api import memcache
 from google.appengine.api import taskqueue
-from muninn.models import Event, AgentStore, SourceAgent
+import webapp2
+from muninn.models import Event, EventBuffer, AgentStore, SourceAgent
+from muninn.models import LegacySourceAgent, MigrationState, SOURCE_KEYS_MIGRATION
+from muninn.models import BATCH_SIZE, get_multi, put_multi
+from muninn import migrations, models
 from muninn.agents import Agent
-from muninn.tests.test_agents import TestAgent, MuteAgent
+from muninn.tests.test_agents import TestAgent, MuteAgent, ReadOnlyAgent
 
 
 class AgentStoreTestCase(unittest.TestCase):
@@ -18,6 +25,10 @@ class AgentStoreTestCase(unittest.TestCase):
         self.testbed.setup_env('muninn')
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=os.path.join(
+            os.path.dirname(__file__), '..', '..'))
+        models._legacy_edges_migrated = False
 
     def tearDown(self):
         self.testbed.deactivate()
@@ -32,6 +43,19 @@ class AgentStoreTestCase(unittest.TestCase):
         agents = AgentStore.all()
         self.assertEqual(len(agents), 9)
 
+    def test_list_agents_projection(self):
+        TestAgent.new('Agent', config={'foo': 'bar'})
+        agents = AgentStore.all(projection=[AgentStore.name])
+        self.assertEqual(len(agents), 1)
+        self.assertEqual(agents[0].name, 'Agent')
+
+    def test_batched_get_put(self):
+        agents = [AgentStore(name=str(i)) for i in range(BATCH_SIZE * 2 + 1)]
+        keys = put_multi(agents)
+        self.assertEqual(keys, [a.key for a in agents])
+        self.assertEqual([a.name for a in get_multi(keys)],
+                         [a.name for a in agents])
+
     def test_agent_events(self):
         source_agent = Agent.new('Source Agent')
         listening_agent = Agent.new('Listening Agent',
@@ -42,11 +66,92 @@ class AgentStoreTestCase(unittest.TestCase):
         source_agent._put_events_queue()
         self.assertIn(listening_agent,
                       SourceAgent.get_listening_agents(source_agent))
+        self.assertEqual([listening_agent.key],
+                         SourceAgent.get_listening_agent_keys(source_agent))
         events = listening_agent.receive_events()
         self.assertEqual(len(events), 1)
         events = listening_agent_2.receive_events()
         self.assertEqual(len(events), 0)
 
+    def test_event_buffer(self):
+        source_agent = Agent.new('Source Agent')
+        listening_agent = Agent.new('Listening Agent',
+                                    source_agents=[source_agent])
+        with EventBuffer():
+            source_agent.add_event({'event_field': 'event_value'})
+            source_agent._put_events_queue()
+            self.assertEqual(len(listening_agent.receive_events()), 0)
+        self.assertEqual(len(listening_agent.receive_events()), 1)
+
+    def test_event_buffer_overflow(self):
+        source_agent = Agent.new('Source Agent')
+        listening_agent = Agent.new('Listening Agent',
+                                    source_agents=[source_agent])
+        with EventBuffer(max_size=2):
+            for i, pending in enumerate([0, 2, 2]):
+                source_agent.add_event(i)
+                source_agent._put_events_queue()
+                self.assertEqual(len(listening_agent.receive_events()),
+                                 pending)
+        self.assertEqual(len(listening_agent.receive_events()), 3)
+
+    def test_event_buffer_failure_after_run(self):
+        source_agent = TestAgent.new('Source Agent')
+        agent = TestAgent.new('Test Agent', source_agents=[source_agent],
+                              deduplicate_output_events=True)
+        listening_agent = TestAgent.new('Listening Agent',
+                                        source_agents=[agent])
+        source_agent.add_event(1)
+        source_agent._put_events_queue()
+        with self.assertRaises(RuntimeError):
+            with EventBuffer():
+                agent.run()
+                raise RuntimeError()
+        stored = agent.key.get(use_cache=False, use_memcache=False)
+        self.assertTrue(stored.last_run)
+        self.assertEqual(len(stored.dedup_hashs), 1)
+        self.assertEqual(len(agent.receive_events()), 0)
+        events = listening_agent.receive_events()
+        self.assertEqual([e.data for e in events], [{'event_data': [1]}])
+
+    def test_event_buffer_failed_put(self):
+        source_agent = TestAgent.new('Source Agent')
+        agent = TestAgent.new('Test Agent', source_agents=[source_agent],
+                              deduplicate_output_events=True)
+        listening_agent = TestAgent.new('Listening Agent',
+                                        source_agents=[agent])
+        source_agent.add_event(1)
+        source_agent._put_events_queue()
+
+        def failing_put_multi(entities, **ctx_options):
+            raise RuntimeError()
+
+        put_multi = models.put_multi
+        models.put_multi = failing_put_multi
+        try:
+            with self.assertRaises(RuntimeError):
+                agent.run()
+        finally:
+            models.put_multi = put_multi
+        stored = agent.key.get(use_cache=False, use_memcache=False)
+        self.assertFalse(stored.last_run)
+        self.assertEqual(stored.dedup_hashs, [])
+        self.assertEqual(len(listening_agent.receive_events()), 0)
+        events = Event.query(Event.target == agent.key).fetch()
+        self.assertEqual([e.data for e in events], [1])
+
+    def test_event_buffer_deletes(self):
+        source_agent = Agent.new('Source Agent')
+        agent = Agent.new('Agent', source_agents=[source_agent])
+        source_agent.add_event(1)
+        source_agent._put_events_queue()
+        events = agent.receive_events()
+        with EventBuffer():
+            events[0].done()
+            events[0].done()
+            self.assertEqual(len(agent.receive_events()), 1)
+        self.assertEqual(len(agent.receive_events()), 0)
+
     def test_agent_properties(self):
         agent = TestAgent.new('Agent', config={'foo': 'bar'})
         self.assertEqual(agent.config, {'foo': 'bar'})
@@ -62,6 +167,33 @@ class AgentStoreTestCase(unittest.TestCase):
         self.assertEqual(SourceAgent.get_source_agents(agent),
                          [source_agent1, source_agent2])
 
+    def test_agent_sources_cache(self):
+        source_agent = TestAgent.new('Source Agent')
+        agent = TestAgent.new('Test Agent', source_agents=[source_agent])
+        self.assertEqual(SourceAgent.get_listening_agent_keys(source_agent),
+                         [agent.key])
+        agent2 = TestAgent.new('Test Agent 2', source_agents=[source_agent])
+        self.assertEqual(SourceAgent.get_listening_agent_keys(source_agent),
+                         [agent.key, agent2.key])
+        self.assertEqual(SourceAgent.get_source_agents(agent2),
+                         [source_agent])
+
+    def test_agent_sources_cache_stale_writes(self):
+        source_agent = TestAgent.new('Source Agent')
+        cache_key = SourceAgent._listeners_cache_key(source_agent.key)
+        # a lookup that read the listeners before the new agent was
+        # saved, and caches its result before...
+        memcache.set(cache_key, [])
+        agent = TestAgent.new('Test Agent', source_agents=[source_agent])
+        self.assertEqual(SourceAgent.get_listening_agent_keys(source_agent),
+                         [agent.key])
+        # ... or after AgentStore.new updated the cache
+        memcache.delete(cache_key)
+        agent2 = TestAgent.new('Test Agent 2', source_agents=[source_agent])
+        memcache.add(cache_key, [agent.key])
+        self.assertEqual(SourceAgent.get_listening_agent_keys(source_agent),
+                         [agent.key, agent2.key])
+
     def test_agent_due(self):
         in_two_hours = datetime.datetime.now() + datetime.timedelta(hours=2)
 
@@ -96,6 +228,84 @@ class AgentStoreTestCase(unittest.TestCase):
                          {'event_data': [1, 2]})
         self.assertTrue(agent.last_run)
 
+    def test_agent_run_marks_events_done(self):
+        source_agent = TestAgent.new('Source Agent')
+        agent = TestAgent.new('Test Agent',
+                              source_agents=[source_agent])
+        source_agent.add_event(1)
+        source_agent._put_events_queue()
+        self.assertEqual(len(agent.receive_events()), 1)
+        agent.run()
+        self.assertEqual(len(agent.receive_events()), 0)
+
+    def test_event_mark_done(self):
+        source_agent = Agent.new('Source Agent')
+        agent = Agent.new('Agent', source_agents=[source_agent])
+        source_agent.add_event(1)
+        source_agent.add_event(2)
+        source_agent._put_events_queue()
+        keys, _ = Event.for_agent(agent.key, [source_agent.key],
+                                  keys_only=True)
+        self.assertEqual(len(keys), 2)
+        Event.mark_done(keys[:1])
+        self.assertEqual(len(agent.receive_events()), 1)
+
+    def test_event_pagination(self):
+        source_agent1 = Agent.new('Source Agent 1')
+        source_agent2 = Agent.new('Source Agent 2')
+        agent = Agent.new('Agent',
+                          source_agents=[source_agent1, source_agent2])
+        for i in range(3):
+            source_agent1.add_event(i)
+            source_agent2.add_event(i)
+        source_agent1._put_events_queue()
+        source_agent2._put_events_queue()
+        seen = []
+        cursor = None
+        for source_keys in ([source_agent1.key, source_agent2.key], []):
+            while True:
+                events, cursor = Event.for_agent(agent.key, source_keys,
+                                                 limit=4,
+                                                 start_cursor=cursor)
+                seen.extend(e.key for e in events)
+                if cursor is None:
+                    break
+            self.assertEqual(len(seen), 6)
+            self.assertEqual(seen, sorted(seen))
+            seen = []
+
+    def test_purge_done_events(self):
+        source_agent = Agent.new('Source Agent')
+        agent = Agent.new('Agent', source_agents=[source_agent])
+        old = Event(data=0, source=source_agent.key, target=agent.key,
+                    is_done=True)
+        old.put()
+        source_agent.add_event(1)
+        source_agent._put_events_queue()
+        self.assertEqual([e.data for e in agent.receive_events()], [1])
+        migrations.purge_done_events()
+        self.assertIsNone(old.key.get(use_cache=False, use_memcache=False))
+        self.assertEqual([e.data for e in agent.receive_events()], [1])
+
+    def test_migrate_source_agents(self):
+        source_agent = TestAgent.new('Source Agent')
+        agent = TestAgent.new('Test Agent')
+        LegacySourceAgent(agent=agent.key, source=source_agent.key).put()
+        self.assertEqual(SourceAgent.get_source_agents(agent), [source_agent])
+        self.assertEqual(SourceAgent.get_listening_agent_keys(source_agent),
+                         [agent.key])
+        migrations.migrate_source_agents()
+        self.assertEqual(agent.key.get().source_keys, [source_agent.key])
+        self.assertEqual(LegacySourceAgent.query().count(), 1)
+        migrations.migrate_source_agents(final=True)
+        self.assertEqual(LegacySourceAgent.query().count(), 0)
+        self.assertTrue(MigrationState.get_by_id(SOURCE_KEYS_MIGRATION).done)
+        agent = agent.key.get()
+        self.assertEqual(SourceAgent.get_source_agents(agent), [source_agent])
+        source_agent.add_event(1)
+        source_agent._put_events_queue()
+        self.assertEqual([e.data for e in agent.receive_events()], [1])
+
     def test_agent_run_taskqueue(self):
         source_agent1 = TestAgent.new('Source Agent 1')
         source_agent1.run_taskqueue()
@@ -103,6 +313,29 @@ class AgentStoreTestCase(unittest.TestCase):
         stats = queue.fetch_statistics()
         self.assertEqual(stats.tasks, 1)
 
+    def test_read_only_webhook(self):
+        agent = ReadOnlyAgent.new('Read Only Agent')
+        for i in range(2):
+            response = webapp2.Response()
+            agent.receive_webhook(webapp2.Request.blank('/'), response)
+            self.assertEqual(response.body, 'ok')
+        stored = agent.key.get(use_cache=False, use_memcache=False)
+        self.assertFalse(stored.is_running)
+        self.assertIsNone(stored.last_run)
+        taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        tasks = taskqueue_stub.get_filtered_tasks(queue_names='default')
+        self.assertEqual(len(tasks), 1)
+        deferred.run(tasks[0].payload)
+        stored = agent.key.get(use_cache=False, use_memcache=False)
+        last_run = memcache.get(models._last_run_cache_key(agent.key))
+        self.assertTrue(last_run)
+        self.assertEqual(stored.last_run, last_run)
+        # an older update doesn't move last_run back
+        models._update_last_run(agent.key,
+                                last_run - datetime.timedelta(minutes=1))
+        stored = agent.key.get(use_cache=False, use_memcache=False)
+        self.assertEqual(stored.last_run, last_run)
+
 
 if __name__ == '__main__':
     unittest.main()